@@ -1,8 +1,12 @@
 import torchaudio
+import soundfile
 from utils import LogMelSpectrogram
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
+import torch.distributed as dist
 import pandas as pd
 import os
+import math
+import json
 from pathlib import Path
 import torch
 from typing import List
@@ -34,6 +38,9 @@ class LibriLight(Dataset):
     def __len__(self):
         return len(self.walker)
 
+    def audio_paths(self) -> List[str]:
+        return [item["path"] for item in self.walker]
+
     def __getitem__(self, idx):
         item = self.walker[idx]
         label = item["label"]
@@ -97,6 +104,12 @@ class LibriLightLibriSpeechDataset(Dataset):
     def __len__(self):
         return len(self.walker)
 
+    def audio_paths(self) -> List[str]:
+        return [
+            self.librispeech_path(item) if type(item) == tuple else item["path"]
+            for item in self.walker
+        ]
+
     def __getitem__(self, idx):
         item = self.walker[idx]
         if type(item) == tuple:
@@ -113,16 +126,20 @@ class LibriLightLibriSpeechDataset(Dataset):
 
         return specs, label, "labeled"
 
-    def load_librispeech_item(self, item):
-        """
-        transform audio pack to spectrogram
-        """
+    @staticmethod
+    def librispeech_path(item):
         fileid, path = item
 
         speaker_id, chapter_id, utterance_id = fileid.split("-")
         fileid_audio = speaker_id + "-" + chapter_id + "-" + utterance_id
         file_audio = fileid_audio + ".flac"
-        file_audio = os.path.join(path, speaker_id, chapter_id, file_audio)
+        return os.path.join(path, speaker_id, chapter_id, file_audio)
+
+    def load_librispeech_item(self, item):
+        """
+        transform audio pack to spectrogram
+        """
+        file_audio = self.librispeech_path(item)
 
         # Load audio
         waveform, sample_rate = torchaudio.load(file_audio)
@@ -133,6 +150,116 @@ class LibriLightLibriSpeechDataset(Dataset):
         return spectrogram, "unlabel"
 
 
+def load_audio_lengths(paths: List[str], cache_path: str) -> List[int]:
+    """
+    Number of frames of every audio file, read from its header without decoding.
+    Lengths are cached in a json manifest keyed by path along with the file's size and
+    mtime, so a replaced file is read again. Rank 0 fills the missing or stale entries
+    while the other ranks wait and read it
+    """
+    if not dist.is_initialized() or dist.get_rank() == 0:
+        cache = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                cache = json.load(f)
+        changed = False
+        for p in paths:
+            stat = os.stat(p)
+            entry = cache.get(p)
+            if entry is None or (entry["size"], entry["mtime_ns"]) != (
+                stat.st_size,
+                stat.st_mtime_ns,
+            ):
+                cache[p] = dict(
+                    size=stat.st_size,
+                    mtime_ns=stat.st_mtime_ns,
+                    frames=soundfile.info(p).frames,
+                )
+                changed = True
+        if changed:
+            tmp_path = cache_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, cache_path)
+    if dist.is_initialized():
+        dist.barrier()
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+    return [cache[p]["frames"] for p in paths]
+
+
+class LengthBucketSampler(Sampler):
+    """
+    Batch sampler grouping utterances of similar length, so batches carry little padding.
+    Indices are sorted by length and split into `num_buckets` buckets, batches are drawn
+    inside a bucket, then the batch order is shuffled every epoch.
+    Lengths are only loaded on the first iteration, so building the dataloader is free.
+    When torch.distributed is initialized every rank takes every world_size-th batch
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        batch_size: int,
+        num_buckets: int = 50,
+        shuffle: bool = True,
+        seed: int = 0,
+        lengths_cache: str = "data/audio_frames.json",
+    ):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.lengths_cache = lengths_cache
+        self.epoch = 0
+        self.num_replicas, self.rank = 1, 0
+        if dist.is_initialized():
+            self.num_replicas, self.rank = dist.get_world_size(), dist.get_rank()
+
+        # bucket sizes only depend on the dataset size
+        n = len(dataset)
+        self.bucket_size = max(1, math.ceil(n / num_buckets))
+        num_batches = sum(
+            math.ceil(min(self.bucket_size, n - i) / batch_size)
+            for i in range(0, n, self.bucket_size)
+        )
+        # same number of batches on every rank
+        self.num_batches = num_batches // self.num_replicas
+        self.buckets = None
+
+    def build_buckets(self):
+        lengths = load_audio_lengths(self.dataset.audio_paths(), self.lengths_cache)
+        order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+        self.buckets = [
+            order[i : i + self.bucket_size]
+            for i in range(0, len(order), self.bucket_size)
+        ]
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_batches
+
+    def __iter__(self):
+        if self.buckets is None:
+            self.build_buckets()
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = [bucket[i] for i in torch.randperm(len(bucket), generator=g)]
+            batches.extend(
+                bucket[i : i + self.batch_size]
+                for i in range(0, len(bucket), self.batch_size)
+            )
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g)]
+        end = self.num_batches * self.num_replicas
+        return iter(batches[self.rank : end : self.num_replicas])
+
+
 # class TimitLibriSpeechDataset(Dataset):
 #     def __init__(
 #         self,
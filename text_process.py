@@ -1,5 +1,6 @@
 import torch
 import json
+from typing import Callable, List, Optional, Tuple
 
 
 class TextProcess:
@@ -25,6 +26,8 @@ class TextProcess:
         self.sos_id = 1
         self.eos_id = 2
         self.blank_id = 0
+        # ids dropped when decoding to text
+        self.skip_ids = (self.sos_id, self.blank_id)
 
     def tokenize(self, data):
         return data
@@ -32,15 +35,43 @@ class TextProcess:
     def text2int(self, s: str) -> torch.Tensor:
         return torch.Tensor([self.label_vocabs[i] for i in s])
 
+    def batch_text2int(
+        self,
+        batch: List[List[str]],
+        alloc: Optional[Callable[[str, Tuple[int, ...]], torch.Tensor]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        map a batch of token sequences to padded int targets and their lengths in one pass.
+        `alloc(key, shape)` gives the int32 host tensors to fill (e.g. PinnedStager.buffer),
+        by default they are allocated in pinned memory (when cuda is available)
+        so they can be copied to GPU with non_blocking
+        """
+        if alloc is None:
+            pin_memory = torch.cuda.is_available()
+
+            def alloc(key, shape):
+                return torch.empty(shape, dtype=torch.int32, pin_memory=pin_memory)
+
+        max_len = max((len(s) for s in batch), default=0)
+        lengths = alloc("lengths", (len(batch),))
+        lengths.copy_(torch.tensor([len(s) for s in batch], dtype=torch.int32))
+        targets = alloc("targets", (len(batch), max_len))
+        targets.fill_(self.blank_id)
+        ids = [self.label_vocabs[i] for s in batch for i in s]
+        # row-major fill of the non-padded positions
+        mask = torch.arange(max_len) < lengths.unsqueeze(1)
+        targets[mask] = torch.tensor(ids, dtype=torch.int32)
+        return targets, lengths
+
     def int2text(self, s: torch.Tensor) -> str:
-        text = ""
+        tokens = []
         for i in s:
-            if i in [self.sos_id, self.blank_id]:
+            if i in self.skip_ids:
                 continue
             if i == self.eos_id:
                 break
-            text += " " + self.vocabs[i]
-        return text
+            tokens.append(" " + self.vocabs[i])
+        return "".join(tokens)
 
     def decode(self, argmax: torch.Tensor):
         """
@@ -51,5 +82,5 @@ class TextProcess:
             if index != self.blank_id:
                 if i != 0 and index == argmax[i - 1]:
                     continue
-                decode.append(index.item())
+                decode.append(int(index))
         return self.int2text(decode)
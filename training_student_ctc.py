@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import torch
+import torch.distributed as dist
 from torch.utils.data import Dataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch import nn, Tensor, optim
 import fairseq
 import transformers
@@ -15,6 +17,7 @@ from transformers import (
 )
 from torch.nn.utils.rnn import pad_sequence
 import os
+import math
 from pathlib import Path
 from dataclasses import dataclass, field
 import random
@@ -27,7 +30,7 @@ import wandb
 import numpy as np
 from pprint import pprint
 from audio_augmentation import SpecAugment, AdaptiveSpecAugment
-from dataset import LibriLightLibriSpeechDataset
+from dataset import LibriLightLibriSpeechDataset, LengthBucketSampler
 from utils import *
 import time
 from text_process import TextProcess
@@ -37,6 +40,17 @@ lr = 0.0005
 max_epochs = 100
 log_idx = 25
 batch_size = 32
+# optimizer steps once every `accum_steps` batches
+accum_steps = 1
+# mixed precision forward, bf16 on Ampere+, fp16 with loss scaling otherwise
+use_amp = torch.cuda.is_available()
+amp_dtype = (
+    torch.bfloat16
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    else torch.float16
+)
+# compile the trained model
+compile_model = torch.cuda.is_available()
 n_fft = 1024
 win_length = 400  # 40ms
 hop_length = 200  # 20ms
@@ -45,17 +59,35 @@ teacher_hiddens = 2
 student_hiddens = 4
 gen = 2
 model_setting = "libri"
+ckpt_dir = "pretrained"
 ckpt_version = 1
 version = ckpt_version + 1
+ckpt_path = os.path.join(
+    ckpt_dir, f"student_{student_hiddens}_hidden_gen_{gen}_{model_setting}_version_{version}.pt"
+)
+# None: checkpoint once per epoch from the epoch loop only
+save_every_n_steps = None
 log_wandb = False
 
+# launch multi-gpu with `torchrun --nproc_per_node=N training_student_ctc.py`
+rank, local_rank, world_size = setup_distributed()
+log_wandb = log_wandb and rank == 0
+# dataloader workers per rank, audio decoding and features run in the workers.
+# persistent train workers take 3/4 of the cores, the test loader the rest
+cpu_per_rank = (os.cpu_count() or 2) // world_size
+train_workers = max(1, cpu_per_rank * 3 // 4)
+test_workers = max(1, cpu_per_rank - train_workers)
+
+if rank == 0:
+    os.makedirs(ckpt_dir, exist_ok=True)
+
 if log_wandb:
     wandb.init(
         project="speech_verification",
         name=f"student_{student_hiddens}_hidden_gen_{gen}_{model_setting}_version_{version}",
     )
 
-device = "cuda:0" if torch.cuda.is_available() else "cpu"
+device = f"cuda:{local_rank}" if torch.cuda.is_available() else "cpu"
 
 """# Self-training"""
 
@@ -125,14 +157,19 @@ def load_conformer_pretrained(no_hidden_layers):
     wav2vec2_conformer.layers = nn.ModuleList(
         [wav2vec2_conformer.layers[i] for i in range(no_hidden_layers)]
     )
+    # random layer skipping leaves parameters without grads on some ranks,
+    # which DDP's gradient all-reduce does not allow
+    if dist.is_initialized():
+        wav2vec2_conformer.config.layerdrop = 0.0
     return wav2vec2_conformer
 
 
 text_process = TextProcess()
 vocab_size = text_process.n_class
+target_stager = PinnedStager(device)
 
 teacher_checkpoint = torch.load(
-    f"pretrained/teacher_2_hidden_libri_subsampling_swish.pt"
+    f"pretrained/teacher_2_hidden_libri_subsampling_swish.pt", map_location="cpu"
 )
 teacher_ckpt = dict()
 for key, val in teacher_checkpoint["conformer_state_dict"].items():
@@ -144,6 +181,8 @@ teacher_model = ConformerModel(
 )
 teacher_model = teacher_model.to(device)
 teacher_model.load_state_dict(teacher_ckpt)
+# teacher only produces pseudo-labels
+teacher_model.eval()
 
 wav2vec2_conformer_student = load_conformer_pretrained(student_hiddens)
 student_model = ConformerModel(
@@ -156,89 +195,131 @@ student_model = ConformerModel(
     is_teacher=True,
 )
 
-if torch.cuda.device_count() > 1:
-    student_model = nn.DataParallel(student_model, device_ids=[0, 1])
 student_model = student_model.to(device)
+if compile_model:
+    # shapes that change between calls (batch size, padded length) are
+    # recompiled once as dynamic instead of once per value
+    student_model.compile(dynamic=None)
+if dist.is_initialized():
+    student_model = DDP(
+        student_model, device_ids=[local_rank], gradient_as_bucket_view=True
+    )
+elif torch.cuda.device_count() > 1:
+    student_model = nn.DataParallel(student_model, device_ids=[0, 1])
 
 
 def count_params(model):
-    if type(model) == nn.DataParallel:
+    if isinstance(model, (nn.DataParallel, DDP)):
         return model.module.count_params()
     return model.count_params()
 
 
 def save_state_dict(model):
-    if type(model) == nn.DataParallel:
+    if isinstance(model, (nn.DataParallel, DDP)):
         return model.module.state_dict()
     return model.state_dict()
 
 
+def save_student_ckpt(model, optimizer, scheduler, epoch, step=None):
+    save_ckpt(
+        dict(
+            conformer_state_dict=save_state_dict(model),
+            scheduler_state_dict=scheduler.state_dict(),
+            optimizer_state_dict=optimizer.state_dict(),
+            config=config,
+            epoch=epoch,
+            step=step,
+        ),
+        ckpt_path,
+    )
+
+
 print(summary(student_model.module, [(300, n_mels,), (1,)]))
 
 
-def decode(encoder_output: Tensor) -> str:
-    argmax = encoder_output.squeeze(0).argmax(-1)
-    return text_process.decode(argmax)
+def decode(encoder_outputs: Tensor) -> List[str]:
+    # a single device to host copy for the whole batch
+    argmax = encoder_outputs.argmax(-1).tolist()
+    return [text_process.decode(a) for a in argmax]
 
 
 def recognize(inputs: Tensor, input_lengths: Tensor, model: nn.Module) -> List[str]:
-    outputs = list()
-
     encoder_outputs, _ = model(inputs, input_lengths)
-
-    for encoder_output in encoder_outputs:
-        predict = decode(encoder_output)
-        outputs.append(predict)
-
-    return outputs
+    return decode(encoder_outputs)
 
 
 def train_epoch(model, dataloader, optimizer, scheduler, criterion, epoch):
     size = len(dataloader)
     start_time = time.perf_counter()
-    for batch_idx, batch in enumerate(dataloader):
+    loss_ring = torch.zeros(log_idx, device=device)
+    for sampler in (dataloader.sampler, dataloader.batch_sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+    optimizer.zero_grad(set_to_none=True)
+    for batch_idx, batch in enumerate(CUDAPrefetcher(dataloader, device)):
         inputs, input_lengths, trans = batch
-        inputs, input_lengths = inputs.to(device), input_lengths.to(device)
 
         # teacher generate pseudo-label for student learning
-        predicted = recognize(inputs, input_lengths, teacher_model)
-
-        # replace the origin transcript of timit dataset
-        for origin_trans, idx in trans:
-            predicted[idx] = origin_trans
-
-        for i in range(len(predicted)):
-            if type(predicted[i]) == str:
-                predicted[i] = predicted[i].split()
-
-        predicted = [text_process.text2int(s) for s in predicted]
-
-        check_zero = [(s.sum() > 0).item() for s in predicted]
-        predicted = [predicted[i] for i, op in enumerate(check_zero) if op == True]
-        inputs = inputs[check_zero]
-        input_lengths = input_lengths[check_zero]
-
-        optimizer.zero_grad()
+        with torch.inference_mode(), torch.autocast(
+            "cuda", dtype=amp_dtype, enabled=use_amp
+        ):
+            predicted = recognize(inputs, input_lengths, teacher_model)
+
+        # labeled utterances keep their origin transcript, the rest use the teacher's
+        labels = {idx: origin_trans for origin_trans, idx in trans}
+        predicted = [
+            labels[i] if i in labels else pred.split()
+            for i, pred in enumerate(predicted)
+        ]
+
+        # drop utterances the teacher decoded to nothing
+        keep = [len(s) > 0 for s in predicted]
+        if not all(keep):
+            predicted = [s for s in predicted if len(s) > 0]
+            inputs = inputs[keep]
+            input_lengths = input_lengths[keep]
+
+        targets, target_lengths = target_stager(
+            *text_process.batch_text2int(predicted, alloc=target_stager.buffer)
+        )
 
-        target_lengths = torch.IntTensor([s.size(0) for s in predicted]).to(device)
-        targets = pad_sequence(predicted, batch_first=True).to(device, torch.int)
+        is_sync = (batch_idx + 1) % accum_steps == 0 or batch_idx + 1 == size
 
-        outputs, output_lengths = model(inputs, input_lengths)
+        with grad_sync_context(model, is_sync):
+            with torch.autocast("cuda", dtype=amp_dtype, enabled=use_amp):
+                outputs, output_lengths = model(inputs, input_lengths)
 
-        loss = criterion(
-            outputs.permute(1, 0, 2), targets, output_lengths, target_lengths
-        )
+            # CTC stays in fp32
+            loss = criterion(
+                outputs.float().permute(1, 0, 2),
+                targets,
+                output_lengths,
+                target_lengths,
+            )
 
-        loss.backward()
+            scaler.scale(loss / accum_steps).backward()
 
-        optimizer.step()
-        scheduler.step()
+        if is_sync:
+            scaler.step(optimizer)
+            scaler.update()
+            scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
 
+        # losses stay in a device ring buffer, synced once every `log_idx` steps
         if log_wandb:
-            wandb.log({"train/epoch": epoch})
-            wandb.log({"train/loss": loss.item()})
-            wandb.log({"train/lr-AdamW": scheduler.get_last_lr()[0]})
-            wandb.log({"train/step": batch_idx})
+            loss_ring[batch_idx % log_idx] = loss.detach()
+            if (batch_idx + 1) % log_idx == 0:
+                wandb.log(
+                    {
+                        "train/epoch": epoch,
+                        "train/loss": loss_ring.mean().item(),
+                        "train/lr-AdamW": scheduler.get_last_lr()[0],
+                        "train/step": batch_idx,
+                    }
+                )
+
+        if save_every_n_steps and (batch_idx + 1) % save_every_n_steps == 0:
+            save_student_ckpt(model, optimizer, scheduler, epoch, batch_idx)
 
         # if batch_idx % log_idx == log_idx - 1:
         #     cost_time = time.perf_counter() - start_time
@@ -249,17 +330,24 @@ def train_epoch(model, dataloader, optimizer, scheduler, criterion, epoch):
 def eval_epoch(model, dataloader, criterion, epoch, run_type="eval"):
     running_loss = 0
     running_wer = 0
+    n_samples = 0
     size = len(dataloader)
-    with torch.no_grad():
-        for batch_idx, batch in enumerate(dataloader):
+    # eval runs a different number of batches per rank, DDP's forward must be bypassed
+    if isinstance(model, DDP):
+        model = model.module
+    # one outcome file per rank, each holds the rank's slice of the test set
+    outcome_path = f"{run_type}.txt" if world_size == 1 else f"{run_type}_{rank}.txt"
+    with torch.no_grad(), open(outcome_path, "w", buffering=1 << 20) as outcome_file:
+        for batch_idx, batch in enumerate(CUDAPrefetcher(dataloader, device)):
             inputs, input_lengths, trans = batch
-            inputs, input_lengths = inputs.to(device), input_lengths.to(device)
 
             trans = [i[0] for i in trans]
 
-            trans = [text_process.text2int(s) for s in trans]
-            target_lengths = torch.IntTensor([s.size(0) for s in trans]).to(device)
-            targets = pad_sequence(trans, batch_first=True).to(device, torch.int)
+            targets, target_lengths = text_process.batch_text2int(
+                trans, alloc=target_stager.buffer
+            )
+            label_sequences = list(map(text_process.int2text, targets.tolist()))
+            targets, target_lengths = target_stager(targets, target_lengths)
 
             outputs, output_lengths = model(inputs, input_lengths)
 
@@ -267,33 +355,35 @@ def eval_epoch(model, dataloader, criterion, epoch, run_type="eval"):
                 outputs.permute(1, 0, 2), targets, output_lengths, target_lengths
             )
 
-            predict_sequences = recognize(inputs, input_lengths, model)
-            label_sequences = list(map(text_process.int2text, targets))
-            list_wer = torch.Tensor(
-                [
-                    jiwer.wer(truth, hypot)
-                    for truth, hypot in zip(label_sequences, predict_sequences)
-                ]
-            )
-            wer = torch.mean(list_wer).item()
+            predict_sequences = decode(outputs)
+            list_wer = [
+                jiwer.wer(truth, hypot)
+                for truth, hypot in zip(label_sequences, predict_sequences)
+            ]
+            wer = sum(list_wer) / len(list_wer)
 
             running_loss += loss.item()
-            running_wer += wer
-
-            with open(f"{run_type}.txt", "w") as f:
-                for truth, pred, wer_val in zip(
-                    label_sequences, predict_sequences, list_wer
-                ):
-                    f.write(f"Actuall: [{truth}]\n")
-                    f.write(f"Predict: [{pred}]\n")
-                    f.write(f"WER: {wer_val * 100:.2f}%\n")
-                    f.write("=" * 10 + "\n")
+            running_wer += sum(list_wer)
+            n_samples += len(list_wer)
+
+            outcome_file.write(
+                "".join(
+                    f"Actuall: [{truth}]\n"
+                    f"Predict: [{pred}]\n"
+                    f"WER: {wer_val * 100:.2f}%\n" + "=" * 10 + "\n"
+                    for truth, pred, wer_val in zip(
+                        label_sequences, predict_sequences, list_wer
+                    )
+                )
+            )
 
             if log_wandb:
-                wandb.log({f"{run_type}/loss": loss.item()})
-                wandb.log({f"{run_type}/wer": wer})
+                wandb.log({f"{run_type}/loss": loss.item(), f"{run_type}/wer": wer})
 
-    return running_loss / len(dataloader), running_wer / len(dataloader)
+    running_loss, size, running_wer, n_samples = sum_ranks(
+        running_loss, size, running_wer, n_samples
+    )
+    return running_loss / size, running_wer / n_samples
 
 
 train_dataset = LibriLightLibriSpeechDataset(subset="train")
@@ -316,42 +406,68 @@ def collate_fn(batch):
     return specs, input_lengths, trans
 
 
+# batches of similar length utterances, sharded across ranks under DDP
+train_sampler = LengthBucketSampler(
+    train_dataset, batch_size=batch_size, num_buckets=50
+)
 train_dataloader = DataLoader(
     train_dataset,
-    batch_size=batch_size,
+    batch_sampler=train_sampler,
     collate_fn=collate_fn,
-    shuffle=True,
     pin_memory=True,
-    num_workers=2,
-    drop_last=False,
+    num_workers=train_workers,
+    persistent_workers=True,
+    prefetch_factor=4,
 )
+# each rank evaluates its own slice of the test set
 test_dataloader = DataLoader(
-    test_dataset,
+    torch.utils.data.Subset(test_dataset, range(rank, len(test_dataset), world_size)),
     batch_size=batch_size,
     collate_fn=collate_fn,
     shuffle=False,
     pin_memory=True,
-    num_workers=2,
+    num_workers=test_workers,
 )
 
-total_steps = len(train_dataloader) * max_epochs
+total_steps = math.ceil(len(train_dataloader) / accum_steps) * max_epochs
 
 print("Total steps:", total_steps)
 
 criterion = nn.CTCLoss().to(device)
-optimizer = optim.AdamW(student_model.parameters(), lr=lr)
+# frozen blocks (freeze_conformer_blocks) are left out of the optimizer
+params = [p for p in student_model.parameters() if p.requires_grad]
+# fused kernel updates all parameters in one launch, foreach is the default off cuda
+optimizer = optim.AdamW(params, lr=lr, fused=device.startswith("cuda"))
 scheduler = optim.lr_scheduler.OneCycleLR(
     optimizer, max_lr=lr, pct_start=0.25, total_steps=total_steps
 )
+# enabled for bf16 too: steps whose grads hold inf/NaN are skipped on the device,
+# so a NaN loss never reaches the weights
+scaler = torch.amp.GradScaler("cuda", enabled=use_amp)
 
 print("Lr:", lr)
 
 if ckpt_version:
     ckpt = torch.load(
-        f"pretrained/student_{student_hiddens}_hidden_gen_2_{model_setting}_version_{ckpt_version}.pt"
+        os.path.join(
+            ckpt_dir,
+            f"student_{student_hiddens}_hidden_gen_2_{model_setting}_version_{ckpt_version}.pt",
+        ),
+        map_location="cpu",
     )
     start_epoch = ckpt.get("epoch", 0)
     optimizer.load_state_dict(ckpt.get("optimizer_state_dict"))
+    # the saved param-group options replace ours, fused included
+    if device.startswith("cuda"):
+        for group in optimizer.param_groups:
+            group["fused"] = True
+            group["foreach"] = None
+            for p in group["params"]:
+                state = optimizer.state.get(p, {})
+                # fused kernels take the step counters on the param's device
+                if torch.is_tensor(state.get("step")):
+                    state["step"] = state["step"].to(p.device, torch.float32)
+    print("Fused AdamW:", optimizer.param_groups[0].get("fused"))
     scheduler.load_state_dict(ckpt.get("scheduler_state_dict"))
 
     print(student_model.module.load_state_dict(ckpt["conformer_state_dict"]))
@@ -392,30 +508,12 @@ print("Student eval wer:", student_eval_wer)
 #     print(f"=" * 10 + f"[{epoch}, {time.perf_counter() - start_time:.2f}s]" + "=" * 10)
 #     train_epoch(student_model, train_dataloader, optimizer, scheduler, criterion, epoch)
 #     eval_loss, eval_wer = eval_epoch(student_model, test_dataloader, criterion, epoch, "val")
-#     if eval_wer < best_wer:
+#     if eval_wer < best_wer and rank == 0:
 #         print(f"Save model at epoch {epoch}, with WER: {eval_wer * 100:.2f}%")
-#         torch.save(
-#             dict(
-#                 conformer_state_dict=save_state_dict(student_model),
-#                 scheduler_state_dict=scheduler.state_dict(),
-#                 optimizer_state_dict=optimizer.state_dict(),
-#                 config=config,
-#                 epoch=epoch
-#             ),
-#             f"student_{student_hiddens}_hidden_gen_{gen}_{model_setting}_version_{version}.pt",
-#         )
+#         save_student_ckpt(student_model, optimizer, scheduler, epoch)
 #         best_wer = eval_wer
 
 # wandb.finish()
 
-# torch.save(
-#     dict(
-#         conformer_state_dict=save_state_dict(student_model),
-#         scheduler_state_dict=scheduler.state_dict(),
-#         optimizer_state_dict=optimizer.state_dict(),
-#         config=config,
-#         epoch=epoch,
-#         step=batch_idx,
-#     ),
-#     f"student_{student_hiddens}_hidden_gen_{gen}_{model_setting}_version_{version}.pt",
-# )
+# save_student_ckpt(student_model, optimizer, scheduler, epoch, batch_idx)
+# wait_ckpt()
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import torch
+import torch.distributed as dist
 from torch.utils.data import Dataset, DataLoader
+from torch.nn.parallel import DistributedDataParallel as DDP
 from torch import nn, Tensor, optim
 import fairseq
 import transformers
@@ -14,6 +16,7 @@ from transformers import (
     Wav2Vec2ConformerForPreTraining,
 )
 import os
+import math
 from pathlib import Path
 from dataclasses import dataclass, field
 import random
@@ -29,7 +32,7 @@ from audio_augmentation import (
     AdaptiveSpecAugment,
     RandomBackgroundNoise,
 )
-from dataset import LibriLight
+from dataset import LibriLight, LengthBucketSampler
 from utils import *
 from text_process import TextProcess
 import numpy as np
@@ -37,12 +40,17 @@ from transformers import Adafactor
 
 num_hidden_layers = 2
 
-wandb.init(
-    project="speech_verification",
-    name=f"conformer_{num_hidden_layers}_hidden_gen_1_libri_subsampling_swish",
-)
+# launch multi-gpu with `torchrun --nproc_per_node=N training_teacher_ctc.py`
+rank, local_rank, world_size = setup_distributed()
+log_wandb = rank == 0
+
+if log_wandb:
+    wandb.init(
+        project="speech_verification",
+        name=f"conformer_{num_hidden_layers}_hidden_gen_1_libri_subsampling_swish",
+    )
 
-device = "cuda:0" if torch.cuda.is_available() else "cpu"
+device = f"cuda:{local_rank}" if torch.cuda.is_available() else "cpu"
 # device = "cuda:0"
 print("Device:", device)
 # device = 'cpu'
@@ -62,6 +70,22 @@ n_mels = 80
 lr = 0.001
 max_epochs = 100
 log_idx = 2
+# optimizer steps once every `accum_steps` batches
+accum_steps = 1
+# mixed precision forward, bf16 on Ampere+, fp16 with loss scaling otherwise
+use_amp = torch.cuda.is_available()
+amp_dtype = (
+    torch.bfloat16
+    if torch.cuda.is_available() and torch.cuda.is_bf16_supported()
+    else torch.float16
+)
+# compile the trained model
+compile_model = torch.cuda.is_available()
+# dataloader workers per rank, audio decoding and features run in the workers.
+# persistent train workers take 3/4 of the cores, the test loader the rest
+cpu_per_rank = (os.cpu_count() or 2) // world_size
+train_workers = max(1, cpu_per_rank * 3 // 4)
+test_workers = max(1, cpu_per_rank - train_workers)
 
 
 class ConformerModel(nn.Module):
@@ -115,56 +139,78 @@ class ConformerModel(nn.Module):
         return sum(p.numel() for p in self.parameters())
 
 
-def decode(encoder_output: Tensor) -> str:
-    argmax = encoder_output.squeeze(0).argmax(-1)
-    return text_process.decode(argmax)
+def decode(encoder_outputs: Tensor) -> List[str]:
+    # a single device to host copy for the whole batch
+    argmax = encoder_outputs.argmax(-1).tolist()
+    return [text_process.decode(a) for a in argmax]
 
 
 def recognize(inputs: Tensor, input_lengths: Tensor, model: nn.Module) -> List[str]:
-    outputs = list()
-
     encoder_outputs, _ = model(inputs, input_lengths)
-
-    for encoder_output in encoder_outputs:
-        predict = decode(encoder_output)
-        outputs.append(predict)
-
-    return outputs
+    return decode(encoder_outputs)
 
 
 def train_epoch(model, dataloader, optimizer, scheduler, criterion, epoch):
     size = len(dataloader)
-    running_loss = 0
-    for batch_idx, batch in enumerate(dataloader):
+    running_loss = torch.zeros((), device=device)
+    n_finite = torch.zeros((), dtype=torch.int64, device=device)
+    loss_ring = torch.zeros(log_idx, device=device)
+    nan_seen = torch.zeros((), dtype=torch.bool, device=device)
+    for sampler in (dataloader.sampler, dataloader.batch_sampler):
+        if hasattr(sampler, "set_epoch"):
+            sampler.set_epoch(epoch)
+    optimizer.zero_grad(set_to_none=True)
+    for batch_idx, batch in enumerate(CUDAPrefetcher(dataloader, device)):
         inputs, input_lengths, targets, target_lengths = batch
-        inputs, input_lengths = inputs.to(device), input_lengths.to(device)
-        targets, target_lengths = targets.to(device), target_lengths.to(device)
 
-        outputs, output_lengths = model(inputs, input_lengths)
+        is_sync = (batch_idx + 1) % accum_steps == 0 or batch_idx + 1 == size
 
-        loss = criterion(
-            outputs.permute(1, 0, 2), targets, output_lengths, target_lengths
-        )
-
-        if torch.isnan(loss).item() == True:
-            break
+        with grad_sync_context(model, is_sync):
+            with torch.autocast("cuda", dtype=amp_dtype, enabled=use_amp):
+                outputs, output_lengths = model(inputs, input_lengths)
 
-        running_loss += loss.item()
-
-        optimizer.zero_grad()
-
-        loss.backward()
+            # CTC stays in fp32
+            loss = criterion(
+                outputs.float().permute(1, 0, 2),
+                targets,
+                output_lengths,
+                target_lengths,
+            )
 
-        optimizer.step()
-        if scheduler:
-            scheduler.step()
+            loss_nan = torch.isnan(loss.detach())
+            nan_seen |= loss_nan
+            # NaN losses are left out of the epoch mean
+            running_loss += torch.where(loss_nan, 0.0, loss.detach())
+            n_finite += ~loss_nan
+
+            scaler.scale(loss / accum_steps).backward()
+
+        if is_sync:
+            scaler.step(optimizer)
+            scaler.update()
+            if scheduler:
+                scheduler.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        # losses stay in a device ring buffer, synced once every `log_idx` steps
+        if log_wandb:
+            loss_ring[batch_idx % log_idx] = loss.detach()
+            if (batch_idx + 1) % log_idx == 0:
+                log = {
+                    "train/epoch": epoch,
+                    "train/loss": loss_ring.mean().item(),
+                }
+                if scheduler:
+                    log["train/lr"] = scheduler.get_last_lr()[0]
+                wandb.log(log)
+
+        # NaN is checked once every `log_idx` steps, the steps in between are
+        # already skipped by the scaler.
+        # all ranks must leave the loop together or the next all-reduce hangs
+        if (batch_idx + 1) % log_idx == 0 and any_rank(nan_seen):
+            break
 
-        wandb.log({"train/epoch": epoch})
-        wandb.log({"train/loss": loss.item()})
-        if scheduler:
-            wandb.log({"train/lr": scheduler.get_last_lr()[0]})
-        
-    return running_loss / len(dataloader)
+    return float(running_loss) / max(int(n_finite), 1)
 
 
 def eval_epoch(model, dataloader, criterion, epoch, run_type="eval"):
@@ -172,11 +218,13 @@ def eval_epoch(model, dataloader, criterion, epoch, run_type="eval"):
     start_time = time.perf_counter()
     running_loss = 0
     running_wer = 0
+    n_samples = 0
+    # eval runs a different number of batches per rank, DDP's forward must be bypassed
+    if isinstance(model, DDP):
+        model = model.module
     with torch.no_grad():
-        for batch_idx, batch in enumerate(dataloader):
+        for batch_idx, batch in enumerate(CUDAPrefetcher(dataloader, device)):
             inputs, input_lengths, targets, target_lengths = batch
-            inputs, input_lengths = inputs.to(device), input_lengths.to(device)
-            targets, target_lengths = targets.to(device), target_lengths.to(device)
 
             outputs, output_lengths = model(inputs, input_lengths)
 
@@ -184,22 +232,24 @@ def eval_epoch(model, dataloader, criterion, epoch, run_type="eval"):
                 outputs.permute(1, 0, 2), targets, output_lengths, target_lengths
             )
 
-            predict_sequences = recognize(inputs, input_lengths, model)
-            label_sequences = list(map(text_process.int2text, targets))
-            wer = torch.Tensor(
-                [
-                    jiwer.wer(truth, hypot)
-                    for truth, hypot in zip(label_sequences, predict_sequences)
-                ]
-            )
-            wer = torch.mean(wer).item()
+            predict_sequences = decode(outputs)
+            label_sequences = list(map(text_process.int2text, targets.tolist()))
+            list_wer = [
+                jiwer.wer(truth, hypot)
+                for truth, hypot in zip(label_sequences, predict_sequences)
+            ]
+            wer = sum(list_wer) / len(list_wer)
             running_loss += loss.item()
-            running_wer += wer
+            running_wer += sum(list_wer)
+            n_samples += len(list_wer)
 
-            wandb.log({f"{run_type}/loss": loss.item()})
-            wandb.log({f"{run_type}/wer": wer})
+            if log_wandb:
+                wandb.log({f"{run_type}/loss": loss.item(), f"{run_type}/wer": wer})
 
-    return running_loss / size, running_wer / size
+    running_loss, size, running_wer, n_samples = sum_ranks(
+        running_loss, size, running_wer, n_samples
+    )
+    return running_loss / size, running_wer / n_samples
 
 
 train_dataset = LibriLight(
@@ -250,22 +300,27 @@ def collate_fn(batch):
     return specs, input_lengths, trans, target_lengths
 
 
+# batches of similar length utterances, sharded across ranks under DDP
+train_sampler = LengthBucketSampler(
+    train_dataset, batch_size=batch_size, num_buckets=50
+)
 train_dataloader = DataLoader(
     train_dataset,
-    batch_size=batch_size,
+    batch_sampler=train_sampler,
     collate_fn=collate_fn,
-    shuffle=True,
     pin_memory=True,
-    num_workers=2,
-    drop_last=False,
+    num_workers=train_workers,
+    persistent_workers=True,
+    prefetch_factor=4,
 )
+# each rank evaluates its own slice of the test set
 test_dataloader = DataLoader(
-    test_dataset,
+    torch.utils.data.Subset(test_dataset, range(rank, len(test_dataset), world_size)),
     batch_size=batch_size,
     collate_fn=collate_fn,
     shuffle=False,
     pin_memory=True,
-    num_workers=2,
+    num_workers=test_workers,
 )
 # test_dataloader = {}
 # for subset in test_subset:
@@ -286,10 +341,14 @@ wav2vec2_conformer = wav2vec2_model.wav2vec2_conformer.encoder
 wav2vec2_conformer.layers = nn.ModuleList(
     [wav2vec2_conformer.layers[i] for i in range(num_hidden_layers)]
 )
+# random layer skipping leaves parameters without grads on some ranks,
+# which DDP's gradient all-reduce does not allow
+if dist.is_initialized():
+    wav2vec2_conformer.config.layerdrop = 0.0
 
 
 def count_params(model):
-    if type(model) == nn.DataParallel:
+    if isinstance(model, (nn.DataParallel, DDP)):
         return model.module.count_params()
     return model.count_params()
 
@@ -304,15 +363,26 @@ print(conformer)
 print(
     summary(conformer, [(300, n_mels), (1,)], dtypes=[torch.float, torch.long]) 
 )
-ckpt = torch.load('pretrained/teacher_2_hidden_libri_subsampling_swish.pt')
+ckpt = torch.load('pretrained/teacher_2_hidden_libri_subsampling_swish.pt', map_location="cpu")
 conformer.load_state_dict(ckpt)
+if compile_model:
+    # shapes that change between calls (batch size, padded length) are
+    # recompiled once as dynamic instead of once per value
+    conformer.compile(dynamic=None)
+if dist.is_initialized():
+    conformer = DDP(conformer, device_ids=[local_rank], gradient_as_bucket_view=True)
 
-total_steps = len(train_dataloader) * max_epochs
+total_steps = math.ceil(len(train_dataloader) / accum_steps) * max_epochs
 
 print("Total steps:", total_steps)
 
 criterion = nn.CTCLoss().to(device)
-optimizer = optim.AdamW(conformer.parameters(), lr=lr, betas=(0.9, 0.9999))
+# frozen blocks (freeze_conformer_blocks) are left out of the optimizer
+params = [p for p in conformer.parameters() if p.requires_grad]
+# fused kernel updates all parameters in one launch, foreach is the default off cuda
+optimizer = optim.AdamW(
+    params, lr=lr, betas=(0.9, 0.9999), fused=device.startswith("cuda")
+)
 # optimizer = Adafactor(
 #     conformer.parameters(),
 #     # lr=lr,
@@ -328,6 +398,9 @@ optimizer = optim.AdamW(conformer.parameters(), lr=lr, betas=(0.9, 0.9999))
 scheduler = optim.lr_scheduler.OneCycleLR(
     optimizer, max_lr=lr, pct_start=0.3, total_steps=total_steps
 )
+# enabled for bf16 too: steps whose grads hold inf/NaN are skipped on the device,
+# so a NaN loss never reaches the weights
+scaler = torch.amp.GradScaler("cuda", enabled=use_amp)
 # scheduler = None
 
 config = {
@@ -341,7 +414,8 @@ config = {
     "no_params": count_params(conformer),
     "augmentation": f"SpecAugment",
 }
-wandb.config = config
+if log_wandb:
+    wandb.config = config
 early_stopping = EarlyStopping()
 
 eval_loss, eval_wer = eval_epoch(
@@ -380,7 +454,8 @@ print("Eval wer:", eval_wer)
     
 # wandb.finish()
 
-# torch.save(
-#     dict(conformer_state_dict=conformer.state_dict(), config=config),
+# save_ckpt(
+#     dict(conformer_state_dict=save_state_dict(conformer), config=config),
 #     f"teacher_{num_hidden_layers}_hidden.pt",
 # )
+# wait_ckpt()
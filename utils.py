@@ -1,10 +1,19 @@
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel as DDP
+import torch.distributed as dist
 import torchaudio
 import math
 import torch
+import os
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 
 test_subset = ["dev-clean", "dev-other", "test-clean", "test-other"]
 
+# single background writer, checkpoints are written in submission order
+_ckpt_pool = ThreadPoolExecutor(max_workers=1)
+_ckpt_futures = []
+
 
 def calc_length(lengths, padding, kernel_size, stride, ceil_mode, repeat_num=1):
     """Calculates the output length of a Tensor passed through a convolution or max pooling layer"""
@@ -117,17 +126,181 @@ class ComposeTransform:
 
 
 def count_params(model):
-    if type(model) == nn.DataParallel:
+    if isinstance(model, (nn.DataParallel, DDP)):
         return model.module.count_params()
     return model.count_params()
 
 
 def save_state_dict(model):
-    if type(model) == nn.DataParallel:
+    if isinstance(model, (nn.DataParallel, DDP)):
         return model.module.state_dict()
     return model.state_dict()
 
 
+def _to_cpu(obj):
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _write_ckpt(state, path):
+    tmp_path = path + ".tmp"
+    torch.save(state, tmp_path, _use_new_zipfile_serialization=True)
+    os.replace(tmp_path, path)
+
+
+def save_ckpt(state, path):
+    """
+    Save checkpoint on rank 0 only. The state is snapshotted to cpu on the caller,
+    serialization runs on a background thread into a temporary file then renamed,
+    so training goes on during the write and an interrupted save never leaves a truncated checkpoint
+    """
+    if dist.is_initialized() and dist.get_rank() != 0:
+        return
+    # raise errors of the saves already finished
+    for future in [f for f in _ckpt_futures if f.done()]:
+        _ckpt_futures.remove(future)
+        future.result()
+    _ckpt_futures.append(_ckpt_pool.submit(_write_ckpt, _to_cpu(state), path))
+
+
+def wait_ckpt():
+    """Block until every pending checkpoint is on disk"""
+    while _ckpt_futures:
+        _ckpt_futures.pop(0).result()
+
+
+def grad_sync_context(model, is_sync):
+    """
+    Skip the DDP gradient all-reduce on accumulation micro-steps,
+    forward and backward must both run inside this context
+    """
+    if not is_sync and isinstance(model, DDP):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def any_rank(flag):
+    """True when the device `flag` is set on any rank, every rank gets the same answer"""
+    flag = flag.to(torch.int32)
+    if dist.is_initialized():
+        dist.all_reduce(flag, op=dist.ReduceOp.MAX)
+    return bool(flag.item())
+
+
+def sum_ranks(*values):
+    """Sum python numbers over all ranks, returned unchanged on single process"""
+    if not dist.is_initialized():
+        return values
+    total = torch.tensor(values, dtype=torch.float64, device="cuda")
+    dist.all_reduce(total)
+    return tuple(total.tolist())
+
+
+def setup_distributed():
+    """
+    Join the NCCL process group when launched with torchrun,
+    return (rank, local_rank, world_size), (0, 0, 1) on single process
+    """
+    if "LOCAL_RANK" not in os.environ:
+        return 0, 0, 1
+    if not dist.is_initialized():
+        dist.init_process_group(backend="nccl")
+    local_rank = int(os.environ["LOCAL_RANK"])
+    torch.cuda.set_device(local_rank)
+    return dist.get_rank(), local_rank, dist.get_world_size()
+
+
+class CUDAPrefetcher:
+    """
+    Iterate a dataloader while copying the next batch to the device on a side stream,
+    so the H2D transfer overlaps with the compute of the current batch.
+    Adapted from apex's data_prefetcher, non-tensor items of the batch are passed through
+    """
+
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.stream = None
+        if self.device.type == "cuda":
+            self.stream = torch.cuda.Stream(self.device)
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def __iter__(self):
+        self.loader = iter(self.dataloader)
+        self.preload()
+        batch = self.next()
+        while batch is not None:
+            yield batch
+            batch = self.next()
+
+    def preload(self):
+        try:
+            batch = next(self.loader)
+        except StopIteration:
+            self.batch = None
+            return
+        ctx = torch.cuda.stream(self.stream) if self.stream else contextlib.nullcontext()
+        with ctx:
+            self.batch = tuple(
+                x.to(self.device, non_blocking=True) if torch.is_tensor(x) else x
+                for x in batch
+            )
+
+    def next(self):
+        batch = self.batch
+        if self.stream is not None and batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            for x in batch:
+                if torch.is_tensor(x):
+                    # the caching allocator must not reuse this memory before compute is done
+                    x.record_stream(current_stream)
+        self.preload()
+        return batch
+
+
+class PinnedStager:
+    """
+    Host tensors are filled in place in pinned buffers kept across calls (`buffer`),
+    then copied to `device` with non_blocking (`__call__`),
+    so a batch is never allocated in pinned memory nor copied on the host every step
+    """
+
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.buffers = {}
+        self.copy_done = None
+        if self.device.type == "cuda":
+            self.copy_done = torch.cuda.Event()
+
+    def buffer(self, key, shape, dtype=torch.int32):
+        """Host tensor of `shape` to fill, a view of the pinned buffer `key`"""
+        if self.copy_done is None:
+            return torch.empty(shape, dtype=dtype)
+        # the last non_blocking copy must be done before its buffers are refilled
+        self.copy_done.synchronize()
+        numel = math.prod(shape)
+        buf = self.buffers.get(key)
+        if buf is None or buf.dtype != dtype or buf.numel() < numel:
+            buf = torch.empty(max(numel, 1), dtype=dtype, pin_memory=True)
+            self.buffers[key] = buf
+        # flat slice keeps the view contiguous for the DMA copy
+        return buf[:numel].view(shape)
+
+    def __call__(self, *tensors):
+        staged = tuple(t.to(self.device, non_blocking=True) for t in tensors)
+        if self.copy_done is not None:
+            self.copy_done.record()
+        return staged
+
+
 class EarlyStopping:
     def __init__(self, tolerance=5, min_delta=0):
 